@@ -1,11 +1,34 @@
 #!/usr/bin/env python3
 
+import asyncio
+import atexit
+import bisect
+import contextlib
+import functools
+import json
+import os
+import re
+import secrets
 import shutil
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
 from pathlib import Path
 from yt_dlp import YoutubeDL
 import speedtest
 
+# yt-dlp only decodes Brotli responses when the brotli package is installed
+try:
+    import brotli  # noqa: F401
+    ACCEPT_ENCODING = "br, gzip, deflate"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
 # -------------------------
 # GLOBAL CONSTANTS
 # -------------------------
@@ -18,50 +41,752 @@ CONNECTION_THRESHOLDS = [
     (0, 1),
 ]
 
+# CONNECTION_THRESHOLDS in ascending order, split for bisect
+_TH_MBPS = tuple(threshold for threshold, _ in sorted(CONNECTION_THRESHOLDS))
+_TH_CONNS = tuple(conns for _, conns in sorted(CONNECTION_THRESHOLDS))
+
+# Speed test results are reused for this many seconds (also across restarts)
+SPEED_CACHE_TTL = 600
+# A failed test is remembered for less time so a recovered network is noticed
+SPEED_FALLBACK_TTL = 60
+SPEED_CACHE_FILE = DOWNLOADS_DIR / ".speedcache.json"
+DEFAULT_SPEED_MBPS = 10
+
+_SPEED_CACHE = {"mbps": None, "ts": 0.0, "ttl": SPEED_CACHE_TTL}
+# Concurrent downloads must not run competing speed tests when the cache expires
+_SPEED_LOCK = threading.Lock()
+
+# Short throughput probe against the speed test server. Only the coarse
+# CONNECTION_THRESHOLDS tier matters, so a couple of seconds is plenty.
+PROBE_STREAMS = 2
+PROBE_MAX_BYTES = 8 * 1024 * 1024
+PROBE_TIME_CAP = 2.0
+PROBE_WINDOW = 0.5
+PROBE_FILE = "random4000x4000.jpg"
+
+# Shared aria2c daemon, reused across downloads so DNS/TLS state stays warm
+ARIA2_RPC_PORT = 6800
+ARIA2_RPC_URL = f"http://127.0.0.1:{ARIA2_RPC_PORT}/jsonrpc"
+ARIA2_POLL_INTERVAL = 0.5
+# Every RPC call must carry this secret. Set ARIA2_RPC_SECRET to share one
+# daemon between worker processes; otherwise each process uses its own token.
+ARIA2_RPC_SECRET = os.environ.get("ARIA2_RPC_SECRET") or secrets.token_hex(16)
+
+_ARIA2_LOCK = threading.Lock()
+_ARIA2_PROC = None
+
+# Source codecs that can be stream copied instead of re-encoded to MP3
+COPY_CONTAINERS = {
+    "aac": "m4a",
+    "mp4a": "m4a",
+    "opus": "opus",
+}
+# LAME VBR quality (-q:a): 2 is ~190 kbps, 4 is ~165 kbps. Sources at or
+# below LOW_BITRATE_KBPS gain nothing from the higher setting.
+MP3_VBR_QUALITY = "2"
+MP3_VBR_QUALITY_LOW = "4"
+LOW_BITRATE_KBPS = 128
+
+# Intermediate downloads that are deleted after conversion go to tmpfs
+# when it is available and has room for them
+SCRATCH_DIR = Path("/dev/shm")
+# Free space required on SCRATCH_DIR as a multiple of the source size. The
+# parallel encode also keeps a segment copy and the MP3 parts (~3.5x total).
+SCRATCH_HEADROOM = 2
+SCRATCH_HEADROOM_PARALLEL = 4
+
+# Extensions accepted when searching the output directory for the download
+AUDIO_EXTENSIONS = frozenset({".webm", ".m4a", ".mp3", ".ogg", ".opus", ".wav"})
+
+# Long sources are split and encoded in parallel (libmp3lame is single threaded).
+# Known artifact: the parts are joined with -c copy, so each join keeps the
+# LAME encoder delay/padding, a gap of roughly 50 ms at up to
+# PARALLEL_ENCODE_MAX_JOBS - 1 points. Acceptable for the long speech-style
+# sources this path targets; shorter sources use a single gapless encode.
+PARALLEL_ENCODE_MIN_SECONDS = 600
+PARALLEL_ENCODE_MIN_CPUS = 4
+PARALLEL_ENCODE_MAX_JOBS = 8
+
+# Idle YoutubeDL instances keyed by the options they were built with. Only
+# the output template and progress hooks vary per call.
+_YDL_POOL = {}
+_YDL_POOL_LOCK = threading.Lock()
+_PER_CALL_OPTS = frozenset({"outtmpl", "progress_hooks"})
+
+# Intermediate progress updates are forwarded at most this often (seconds)
+PROGRESS_HOOK_INTERVAL = 0.25
+
+# Only the end of ffmpeg's log is kept for error messages
+FFMPEG_LOG_TAIL = 50
+# Keys written by -progress; values may be space padded ("speed=  41x")
+_FFMPEG_PROGRESS_LINE = re.compile(
+    r"^(?:frame|fps|stream_\d+_\d+_q|bitrate|total_size|out_time(?:_us|_ms)?"
+    r"|dup_frames|drop_frames|speed|progress)="
+)
+
+_SIZE_UNITS = ("B", "KB", "MB", "GB")
+
 def human_readable_size(size_bytes):
     """Convert file size to human readable format"""
-    if size_bytes == 0:
+    size_bytes = int(size_bytes)
+    if size_bytes <= 0:
         return "0 B"
-    size_names = ["B", "KB", "MB", "GB"]
-    i = 0
-    while size_bytes >= 1024 and i < len(size_names) - 1:
-        size_bytes /= 1024.0
-        i += 1
-    return f"{size_bytes:.2f} {size_names[i]}"
+    # Each unit is 10 more bits; the highest set bit picks the unit directly
+    i = min((size_bytes.bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f"{size_bytes / (1 << (10 * i)):.2f} {_SIZE_UNITS[i]}"
 
 def human_readable_speed(mbps):
     if mbps >= 1000:
         return f"{mbps/1000:.2f} Gbps"
     return f"{mbps:.2f} Mbps"
 
-def measure_download_speed():
+def _load_speed_cache():
+    """Populate the in-memory speed cache from disk if it is still fresh"""
     try:
-        st = speedtest.Speedtest()
-        st.get_best_server()
-        st.download(threads=None)
-        dl_bps = st.results.dict().get("download", 0)
-        return dl_bps / 1_000_000.0
-    except Exception:
-        return 10  # Default speed if test fails
+        data = json.loads(SPEED_CACHE_FILE.read_text())
+        ttl = float(data.get("ttl", SPEED_CACHE_TTL))
+        if time.time() - float(data["ts"]) < ttl:
+            _SPEED_CACHE["mbps"] = float(data["mbps"])
+            _SPEED_CACHE["ts"] = float(data["ts"])
+            _SPEED_CACHE["ttl"] = ttl
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+def _save_speed_cache():
+    # Write to a temp file and rename so readers never see a partial file
+    tmp = None
+    try:
+        SPEED_CACHE_FILE.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=SPEED_CACHE_FILE.parent, suffix=".tmp", delete=False) as tmp:
+            json.dump(_SPEED_CACHE, tmp)
+        os.replace(tmp.name, SPEED_CACHE_FILE)
+    except OSError:
+        if tmp is not None:
+            Path(tmp.name).unlink(missing_ok=True)
+
+def _cached_speed():
+    """Return the cached speed if it is still fresh, else None"""
+    if _SPEED_CACHE["mbps"] is None:
+        _load_speed_cache()
+    if _SPEED_CACHE["mbps"] is not None and time.time() - _SPEED_CACHE["ts"] < _SPEED_CACHE["ttl"]:
+        return _SPEED_CACHE["mbps"]
+    return None
+
+def _probe_throughput(server_url):
+    """Download from the speed test server for at most PROBE_TIME_CAP seconds and return Mbps.
+
+    Stops early once the rolling PROBE_WINDOW throughput reaches the highest
+    CONNECTION_THRESHOLDS tier, since a faster result would not change anything.
+    """
+    url = f"{os.path.dirname(server_url)}/{PROBE_FILE}"
+    top_mbps = max(threshold for threshold, _ in CONNECTION_THRESHOLDS)
+    headers = {"User-Agent": speedtest.build_user_agent(), "Cache-Control": "no-cache"}
+
+    lock = threading.Lock()
+    stop = threading.Event()
+    received = [0]
+    start = time.monotonic()
+    deadline = start + PROBE_TIME_CAP
 
+    def worker(stream_id):
+        req = urllib.request.Request(f"{url}?x={int(start * 1000)}.{stream_id}", headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=PROBE_TIME_CAP) as resp:
+                while not stop.is_set() and time.monotonic() < deadline:
+                    chunk = resp.read(65536)
+                    if not chunk:
+                        break
+                    with lock:
+                        received[0] += len(chunk)
+                        if received[0] >= PROBE_MAX_BYTES:
+                            stop.set()
+        except OSError:
+            pass
+
+    workers = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(PROBE_STREAMS)]
+    for t in workers:
+        t.start()
+
+    samples = deque([(start, 0)])
+    while any(t.is_alive() for t in workers):
+        time.sleep(0.05)
+        now = time.monotonic()
+        with lock:
+            total = received[0]
+        samples.append((now, total))
+        # Keep the oldest sample that still spans a full window
+        while len(samples) > 2 and now - samples[1][0] >= PROBE_WINDOW:
+            samples.popleft()
+        t0, b0 = samples[0]
+        if now - t0 >= PROBE_WINDOW and (total - b0) * 8 / (now - t0) / 1_000_000.0 >= top_mbps:
+            stop.set()
+            break
+
+    stop.set()
+    for t in workers:
+        t.join(timeout=1)
+
+    elapsed = time.monotonic() - start
+    with lock:
+        total = received[0]
+    if not total or elapsed <= 0:
+        raise RuntimeError("Speed probe received no data")
+    mbps = total * 8 / elapsed / 1_000_000.0
+    # The rolling rate excludes TCP slow start, so prefer it when available
+    t0, b0 = samples[0]
+    t1, b1 = samples[-1]
+    if t1 - t0 >= PROBE_WINDOW:
+        mbps = max(mbps, (b1 - b0) * 8 / (t1 - t0) / 1_000_000.0)
+    return mbps
+
+def measure_download_speed(force=False):
+    """Return the download speed in Mbps, reusing a recent measurement unless force=True"""
+    if os.environ.get("SKIP_SPEEDTEST") == "1":
+        try:
+            return float(os.environ.get("SPEEDTEST_DEFAULT_MBPS", DEFAULT_SPEED_MBPS))
+        except ValueError:
+            return DEFAULT_SPEED_MBPS
+
+    with _SPEED_LOCK:
+        # Checked under the lock so requests waiting on a refresh reuse its result
+        if not force:
+            cached = _cached_speed()
+            if cached is not None:
+                return cached
+
+        try:
+            st = speedtest.Speedtest()
+            st.get_best_server()
+            mbps = _probe_throughput(st.best["url"])
+            ttl = SPEED_CACHE_TTL
+        except Exception:
+            # Default speed if test fails, cached so unreachable servers are not retried per request
+            mbps = DEFAULT_SPEED_MBPS
+            ttl = SPEED_FALLBACK_TTL
+
+        _SPEED_CACHE["mbps"] = mbps
+        _SPEED_CACHE["ts"] = time.time()
+        _SPEED_CACHE["ttl"] = ttl
+        _save_speed_cache()
+        return mbps
+
+@functools.lru_cache(maxsize=128)
 def choose_connections(mbps):
-    for threshold, conns in CONNECTION_THRESHOLDS:
-        if mbps >= threshold:
-            return conns
-    return 1
+    i = bisect.bisect_right(_TH_MBPS, mbps) - 1
+    return _TH_CONNS[i] if i >= 0 else 1
 
+@functools.lru_cache(maxsize=None)
 def check_tool_exists(tool_name):
     return shutil.which(tool_name) is not None
 
+# PATH does not change while the process runs, so look these up once
+_HAS_ARIA2 = check_tool_exists("aria2c")
+_HAS_FFMPEG = check_tool_exists("ffmpeg")
+
+def _copy_extension(acodec):
+    """Return the container extension acodec can be stream copied into, or None"""
+    if not acodec:
+        return None
+    return COPY_CONTAINERS.get(acodec.split(".")[0].lower())
+
+def _mp3_encode_args(quality):
+    """ffmpeg output options for the MP3 encode"""
+    return [
+        "-af", "aresample=async=1",
+        "-codec:a", "libmp3lame",
+        "-q:a", quality,
+        "-compression_level", "7",
+        "-ac", "2",
+        "-ar", "44100",
+    ]
+
+@functools.lru_cache(maxsize=128)
 def safe_outtmpl(output_dir):
-    # Create the output directory if it doesn't exist
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    # The caller is responsible for creating output_dir
     return str(Path(output_dir) / "%(title).200s.%(ext)s")
 
+def _aria2_rpc(method, *params):
+    """Call a method on the aria2c JSON-RPC interface and return its result"""
+    payload = json.dumps({
+        "jsonrpc": "2.0",
+        "id": "youtube-audio-backend",
+        "method": f"aria2.{method}",
+        "params": [f"token:{ARIA2_RPC_SECRET}", *params],
+    }).encode()
+    req = urllib.request.Request(ARIA2_RPC_URL, data=payload, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            body = json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        # aria2c reports RPC errors with a non-200 status and a JSON body
+        body = json.loads(e.read() or b"{}")
+        body.setdefault("error", {"message": str(e)})
+    if "error" in body:
+        raise RuntimeError(body["error"].get("message", "aria2c RPC error"))
+    return body["result"]
+
+def _ensure_aria2_daemon():
+    """Start the shared aria2c RPC daemon if needed. Returns True when it is reachable."""
+    global _ARIA2_PROC
+    with _ARIA2_LOCK:
+        if _ARIA2_PROC is not None and _ARIA2_PROC.poll() is None:
+            return True
+
+        # Another worker process may already be running the daemon. It is only
+        # reused when it accepts our secret.
+        try:
+            _aria2_rpc("getVersion")
+            return True
+        except (OSError, RuntimeError, ValueError):
+            pass
+
+        if not _HAS_ARIA2:
+            return False
+
+        proc = subprocess.Popen(
+            [
+                "aria2c",
+                "--enable-rpc",
+                f"--rpc-listen-port={ARIA2_RPC_PORT}",
+                f"--rpc-secret={ARIA2_RPC_SECRET}",
+                f"--stop-with-process={os.getpid()}",
+                "--max-concurrent-downloads=8",
+                "--max-connection-per-server=16",
+                "--min-split-size=1M",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        for _ in range(50):
+            try:
+                _aria2_rpc("getVersion")
+                _ARIA2_PROC = proc
+                atexit.register(proc.terminate)
+                return True
+            except (OSError, RuntimeError, ValueError):
+                if proc.poll() is not None:
+                    break
+                time.sleep(0.1)
+
+        proc.terminate()
+        return False
+
+def _aria2_download(media_url, dest, connections, headers=None, progress_hook=None):
+    """Download media_url to dest through the aria2c daemon, reporting yt-dlp style progress"""
+    options = {
+        # Absolute, since the daemon may run in another working directory
+        "dir": str(dest.parent.resolve()),
+        "out": dest.name,
+        "split": str(connections),
+        "max-connection-per-server": str(connections),
+        "min-split-size": "1M",
+        "allow-overwrite": "true",
+        "auto-file-renaming": "false",
+    }
+    if headers:
+        options["header"] = [f"{key}: {value}" for key, value in headers.items()]
+
+    gid = _aria2_rpc("addUri", [media_url], options)
+    state = None
+    try:
+        while True:
+            status = _aria2_rpc("tellStatus", gid, ["status", "totalLength", "completedLength", "downloadSpeed", "errorMessage"])
+            state = status["status"]
+            if state in ("error", "removed"):
+                raise RuntimeError(f"aria2c download failed: {status.get('errorMessage', state)}")
+
+            if progress_hook:
+                total = int(status["totalLength"])
+                done = int(status["completedLength"])
+                speed = int(status["downloadSpeed"])
+                percent = done * 100.0 / total if total else 0.0
+                eta = (total - done) // speed if speed else None
+                progress_hook({
+                    "status": "finished" if state == "complete" else "downloading",
+                    "filename": str(dest),
+                    "downloaded_bytes": done,
+                    "total_bytes": total or None,
+                    "speed": speed,
+                    "eta": eta,
+                    "_percent_str": f"{percent:5.1f}%",
+                    "_speed_str": f"{human_readable_size(speed)}/s",
+                    "_eta_str": f"{eta // 60:02d}:{eta % 60:02d}" if eta is not None else "Unknown",
+                })
+
+            if state == "complete":
+                return dest
+            time.sleep(ARIA2_POLL_INTERVAL)
+    finally:
+        _aria2_discard(gid, dest, stop=state not in ("complete", "error", "removed"))
+
+def _aria2_discard(gid, dest, stop):
+    """Drop a download from the aria2c daemon.
+
+    With stop=True the download is aborted first and this waits until aria2c
+    has stopped writing, so a fallback downloader can safely reuse the path.
+    Any leftover <dest>.aria2 control file is removed.
+    """
+    try:
+        if stop:
+            _aria2_rpc("forceRemove", gid)
+            for _ in range(50):
+                if _aria2_rpc("tellStatus", gid, ["status"])["status"] == "removed":
+                    break
+                time.sleep(0.1)
+        _aria2_rpc("removeDownloadResult", gid)
+    except (OSError, RuntimeError, ValueError):
+        pass
+    try:
+        dest.with_name(dest.name + ".aria2").unlink(missing_ok=True)
+    except OSError:
+        pass
+
+def _throttle_progress_hook(progress_hook, interval=PROGRESS_HOOK_INTERVAL):
+    """Wrap progress_hook so intermediate updates fire at most once per interval.
+
+    Status changes such as "finished" are always passed through.
+    """
+    last_call = [0.0]
+
+    def throttled(progress):
+        if progress.get("status") in ("downloading", "converting"):
+            now = time.monotonic()
+            if now - last_call[0] < interval:
+                return
+            last_call[0] = now
+        progress_hook(progress)
+
+    return throttled
+
+def _pick_direct_audio_format(info):
+    """Return an audio-only format that can be fetched with plain HTTP(S), or None.
+
+    Prefers the format yt-dlp selected, otherwise the best matching entry of
+    info["formats"] (which yt-dlp sorts from worst to best).
+    """
+    for fmt in [info, *reversed(info.get("formats") or [])]:
+        if (
+            fmt.get("url")
+            and fmt.get("protocol") in ("http", "https")
+            and fmt.get("acodec") not in (None, "none")
+            and fmt.get("vcodec") == "none"
+        ):
+            return fmt
+    return None
+
+async def _aria2c_cli_download(media_url, dest, connections, headers=None):
+    """Download media_url to dest with a one-off aria2c process"""
+    cmd = [
+        "aria2c",
+        "-x", str(connections),
+        "-s", str(connections),
+        "-k", "1M",
+        "--allow-overwrite=true",
+        "--auto-file-renaming=false",
+        "--console-log-level=error",
+        "--summary-interval=0",
+        "--dir", str(dest.parent),
+        "-o", dest.name,
+    ]
+    for key, value in (headers or {}).items():
+        cmd += ["--header", f"{key}: {value}"]
+    cmd.append(media_url)
+
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"aria2c exited with code {proc.returncode}: {stderr.decode(errors='replace').strip()}")
+    return dest
+
+def _download_error(e):
+    """Translate a yt-dlp exception into a user facing RuntimeError"""
+    error_msg = str(e)
+    if "Sign in to confirm you're not a bot" in error_msg:
+        return RuntimeError("YouTube is requesting bot verification. Please try a different video or try again later.")
+    elif "Private video" in error_msg:
+        return RuntimeError("This is a private video and cannot be downloaded.")
+    elif "Video unavailable" in error_msg:
+        return RuntimeError("This video is unavailable or has been removed.")
+    else:
+        return RuntimeError(f"Download failed: {error_msg}")
+
+def _make_scratch_dir(expected_size=None, headroom=SCRATCH_HEADROOM):
+    """Create a temporary directory for intermediate files.
+
+    tmpfs is only used when the size is known and fits, since container shm
+    mounts are often just 64 MB. Otherwise the system temp dir is used.
+    """
+    base = None
+    if expected_size and SCRATCH_DIR.is_dir():
+        try:
+            if shutil.disk_usage(SCRATCH_DIR).free > headroom * expected_size:
+                base = SCRATCH_DIR
+        except OSError:
+            pass
+    return Path(tempfile.mkdtemp(prefix="yt_audio_", dir=base))
+
+def _ydl_pool_key(ytdlp_opts):
+    return frozenset((key, repr(value)) for key, value in ytdlp_opts.items() if key not in _PER_CALL_OPTS)
+
+@contextlib.contextmanager
+def _pooled_ydl(ytdlp_opts):
+    """Borrow a YoutubeDL matching ytdlp_opts instead of constructing one per request.
+
+    YoutubeDL is not thread safe, so an instance serves one call at a time and
+    concurrent calls get their own. Instances that raise are closed and not returned to the pool.
+    """
+    key = _ydl_pool_key(ytdlp_opts)
+    with _YDL_POOL_LOCK:
+        idle = _YDL_POOL.setdefault(key, [])
+        entry = idle.pop() if idle else None
+
+    if entry is None:
+        hooks = []
+
+        def dispatch(progress):
+            for hook in hooks:
+                hook(progress)
+
+        opts = {k: v for k, v in ytdlp_opts.items() if k not in _PER_CALL_OPTS}
+        opts["progress_hooks"] = [dispatch]
+        entry = (YoutubeDL(opts), hooks)
+
+    ydl, hooks = entry
+    ydl.params["outtmpl"]["default"] = ytdlp_opts["outtmpl"]
+    hooks[:] = ytdlp_opts.get("progress_hooks") or []
+    try:
+        yield ydl
+    except BaseException:
+        # Discarded instances still need close() to save cookies and release connections
+        ydl.close()
+        raise
+
+    hooks.clear()
+    with _YDL_POOL_LOCK:
+        _YDL_POOL[key].append(entry)
+
+def _extract_info(ytdlp_opts, url):
+    """Extract video info without downloading. Returns (info, planned output file)."""
+    try:
+        with _pooled_ydl(ytdlp_opts) as ydl:
+            info = ydl.extract_info(url, download=False)
+            planned_file = Path(ydl.prepare_filename(info)) if info else None
+    except Exception as e:
+        raise _download_error(e)
+    return info, planned_file
+
+def _ytdlp_download(ytdlp_opts, info):
+    """Download a previously extracted info dict with yt-dlp's own downloader"""
+    try:
+        with _pooled_ydl(ytdlp_opts) as ydl:
+            return ydl.process_ie_result(info, download=True)
+    except Exception as e:
+        raise _download_error(e)
+
+async def _run_ffmpeg(cmd, progress_hook=None, duration=None, stdin=None, cwd=None):
+    """Run an ffmpeg command without blocking the event loop.
+
+    stderr is streamed line by line and only the last FFMPEG_LOG_TAIL lines
+    are kept. With a progress_hook, ffmpeg's -progress output is reported
+    as "converting" updates. Returns the kept log tail on success.
+    """
+    cmd = [cmd[0], "-nostats", *cmd[1:]]
+    if progress_hook:
+        cmd[1:1] = ["-progress", "pipe:2"]
+
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=stdin,
+        cwd=cwd,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    tail = deque(maxlen=FFMPEG_LOG_TAIL)
+    try:
+        async for raw_line in proc.stderr:
+            line = raw_line.decode(errors="replace").rstrip()
+            if progress_hook and _FFMPEG_PROGRESS_LINE.match(line):
+                key, _, value = line.partition("=")
+                if key == "out_time_us":
+                    try:
+                        out_time = int(value) / 1_000_000.0
+                    except ValueError:
+                        continue
+                    update = {"status": "converting", "out_time": out_time}
+                    if duration:
+                        update["_percent_str"] = f"{min(out_time * 100.0 / duration, 100.0):5.1f}%"
+                    progress_hook(update)
+                continue
+            if line:
+                tail.append(line)
+
+        await proc.wait()
+    finally:
+        # Cancellation (client disconnect, failed sibling task) must not leave ffmpeg running
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+    log_tail = "\n".join(tail)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=log_tail)
+    return log_tail
+
+async def _probe_duration(path):
+    """Return the media duration in seconds using ffprobe, or None if unknown"""
+    if not check_tool_exists("ffprobe"):
+        return None
+    proc = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        str(path),
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+    stdout, _ = await proc.communicate()
+    try:
+        return float(stdout.decode().strip())
+    except ValueError:
+        return None
+
+def _parallel_jobs(duration):
+    """Number of chunks to encode a source of this duration in (1 means a single encode)"""
+    cpus = os.cpu_count() or 1
+    if duration and duration > PARALLEL_ENCODE_MIN_SECONDS and cpus >= PARALLEL_ENCODE_MIN_CPUS:
+        return min(cpus, PARALLEL_ENCODE_MAX_JOBS)
+    return 1
+
+async def _encode_mp3_parallel(src, dst, duration, jobs, quality):
+    """Split src into segments without re-decoding, encode them concurrently and join the MP3s.
+
+    Segments live next to src (tmpfs when it was downloaded there). The joined
+    file has short gaps at the segment boundaries, see PARALLEL_ENCODE_MIN_SECONDS.
+    """
+    work_dir = Path(tempfile.mkdtemp(prefix=".segments_", dir=src.parent))
+    try:
+        # The segment muxer treats % in its output path as a pattern, so write
+        # relative to work_dir rather than embedding the (user chosen) parent path
+        await _run_ffmpeg([
+            "ffmpeg", "-y",
+            "-i", str(src.resolve()),
+            "-map", "0:a:0",
+            "-c", "copy",
+            "-f", "segment",
+            "-segment_time", f"{duration / jobs:.3f}",
+            "-reset_timestamps", "1",
+            f"seg_%03d{src.suffix}",
+        ], cwd=work_dir)
+        segments = sorted(work_dir.glob(f"seg_*{src.suffix}"))
+
+        # Each encode is its own ffmpeg process, so the event loop only waits
+        limit = asyncio.Semaphore(jobs)
+
+        async def encode(segment):
+            out = segment.with_suffix(".mp3")
+            async with limit:
+                await _run_ffmpeg(["ffmpeg", "-y", "-i", str(segment), "-map", "0:a:0", *_mp3_encode_args(quality), str(out)])
+            return out
+
+        # On the first failure, cancel the remaining encodes (which kills their
+        # ffmpeg processes) before work_dir is removed
+        tasks = [asyncio.ensure_future(encode(segment)) for segment in segments]
+        try:
+            parts = await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        list_file = work_dir / "list.txt"
+        # Entries are resolved relative to the list file, which avoids quoting the parent path
+        list_file.write_text("".join(f"file '{part.name}'\n" for part in parts))
+        await _run_ffmpeg([
+            "ffmpeg", "-y",
+            "-f", "concat",
+            "-safe", "0",
+            "-i", str(list_file),
+            "-c", "copy",
+            str(dst),
+        ])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+async def _download_mp3_piped(info, dst, quality, connections, progress_hook=None):
+    """Download the selected format with yt-dlp to stdout and encode it with ffmpeg as it arrives.
+
+    The extracted info is handed over with --load-info-json so the child
+    process does not fetch the page again.
+    """
+    with tempfile.NamedTemporaryFile("w", suffix=".info.json", delete=False) as info_file:
+        json.dump(YoutubeDL.sanitize_info(info), info_file)
+
+    read_fd, write_fd = os.pipe()
+    downloader = None
+    try:
+        downloader = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "yt_dlp",
+            "--ignore-config",
+            "--load-info-json", info_file.name,
+            "-f", info["format_id"],
+            "-N", str(connections),
+            "--quiet", "--no-warnings",
+            "-o", "-",
+            stdout=write_fd,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        # ffmpeg sees EOF only once no process holds the write end
+        os.close(write_fd)
+        write_fd = None
+
+        cmd = [
+            "ffmpeg", "-y",
+            "-threads", "0",
+            "-i", "pipe:0",
+            "-map", "0:a:0",
+            *_mp3_encode_args(quality),
+            str(dst)
+        ]
+        # Encoding keeps pace with the download here, so report its position as
+        # download progress, which is what the GUI and SSE consumers track
+        report = None
+        if progress_hook:
+            def report(update):
+                progress_hook({**update, "status": "downloading", "filename": str(dst)})
+
+        encode = _run_ffmpeg(cmd, report, info.get("duration"), stdin=read_fd)
+        download_result, encode_result = await asyncio.gather(
+            downloader.communicate(), encode, return_exceptions=True
+        )
+        if isinstance(download_result, BaseException):
+            raise download_result
+
+        # A failed download usually makes ffmpeg fail on truncated input too, so the
+        # download error wins unless yt-dlp only died because ffmpeg closed the pipe
+        download_err = download_result[1].decode(errors="replace").strip()
+        if downloader.returncode != 0 and "Broken pipe" not in download_err:
+            dst.unlink(missing_ok=True)
+            raise _download_error(RuntimeError(download_err))
+        if isinstance(encode_result, BaseException):
+            dst.unlink(missing_ok=True)
+            raise encode_result
+    finally:
+        if downloader is not None and downloader.returncode is None:
+            downloader.kill()
+            await downloader.wait()
+        os.close(read_fd)
+        if write_fd is not None:
+            os.close(write_fd)
+        os.unlink(info_file.name)
+
 # -----------------------------------------------------------
 # MAIN FUNCTION - Fixed NoneType iteration error
 # -----------------------------------------------------------
-def download_audio_from_youtube(url, output_dir=None, convert_to_mp3=False, keep_original=True, progress_hook=None):
+async def download_audio_from_youtube(url, output_dir=None, convert_to_mp3=False, keep_original=True, progress_hook=None, prefer_copy=False):
     # Backward compatibility: if output_dir not provided, use old default
     if output_dir is None:
         output_dir = DOWNLOADS_DIR
@@ -70,21 +795,9 @@ def download_audio_from_youtube(url, output_dir=None, convert_to_mp3=False, keep
     output_path = Path(output_dir)
     output_path.mkdir(parents=True, exist_ok=True)
 
-    print("Measuring internet download speed...")
-    try:
-        mbps = measure_download_speed()
-        print(f"Speed: {human_readable_speed(mbps)}")
-        connections = choose_connections(mbps)
-        print(f"Using {connections} connections")
-    except Exception:
-        mbps = 0
-        connections = 1
-        print("Speed test failed, using default connection")
-
-    use_aria2 = check_tool_exists("aria2c") and connections > 1
-
-    external_downloader = "aria2c" if use_aria2 else None
-    external_downloader_args = ["-x", str(connections), "-s", str(connections), "-k", "1M"] if use_aria2 else []
+    # yt-dlp calls hooks for every downloaded block; callers only need a few per second
+    if progress_hook:
+        progress_hook = _throttle_progress_hook(progress_hook)
 
     # Enhanced yt-dlp options to avoid bot detection
     ytdlp_opts = {
@@ -96,8 +809,6 @@ def download_audio_from_youtube(url, output_dir=None, convert_to_mp3=False, keep
         "ignoreerrors": True,
         "postprocessors": [],
         "skip_download": False,
-        "external_downloader": external_downloader,
-        "external_downloader_args": external_downloader_args,
         "writeinfojson": False,
         "overwrites": True,
         
@@ -107,146 +818,272 @@ def download_audio_from_youtube(url, output_dir=None, convert_to_mp3=False, keep
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
             "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
             "Accept-Language": "en-us,en;q=0.5",
-            "Accept-Encoding": "gzip,deflate",
+            "Accept-Encoding": ACCEPT_ENCODING,
             "Accept-Charset": "ISO-8859-1,utf-8;q=0.7,*;q=0.7",
             "Connection": "keep-alive",
         },
         "sleep_interval": 1,
         "max_sleep_interval": 2,
         "retries": 10,
+        "extractor_retries": 3,
         "fragment_retries": 10,
         "skip_unavailable_fragments": True,
         "keep_fragments": False,
         "noprogress": True,
+
+        # Larger request chunks and write buffer for yt-dlp's own downloader
+        "http_chunk_size": 10 * 1024 * 1024,
+        "buffersize": 65536,
     }
 
-    if progress_hook:
-        ytdlp_opts["progress_hooks"] = [progress_hook]
+    # The speed test and the YouTube metadata requests are independent,
+    # so run the speed test in the background while extracting info
+    print("Measuring internet download speed...")
+    speed_task = asyncio.create_task(asyncio.to_thread(measure_download_speed))
 
     try:
-        with YoutubeDL(ytdlp_opts) as ydl:
-            try:
-                info = ydl.extract_info(url, download=True)
-            except Exception as e:
-                print(f"First attempt failed: {e}. Retrying...")
-                ytdlp_opts_retry = ytdlp_opts.copy()
-                ytdlp_opts_retry["quiet"] = False
-                with YoutubeDL(ytdlp_opts_retry) as ydl_retry:
-                    info = ydl_retry.extract_info(url, download=True)
-                    
-    except Exception as e:
-        error_msg = str(e)
-        if "Sign in to confirm you're not a bot" in error_msg:
-            raise RuntimeError("YouTube is requesting bot verification. Please try a different video or try again later.")
-        elif "Private video" in error_msg:
-            raise RuntimeError("This is a private video and cannot be downloaded.")
-        elif "Video unavailable" in error_msg:
-            raise RuntimeError("This video is unavailable or has been removed.")
-        else:
-            raise RuntimeError(f"Download failed: {error_msg}")
-
-    # ---- FIXED FILE DETECTION ----
-    downloaded_file = None
-
-    # Check if info is None (download might have failed silently)
+        info, planned_file = await asyncio.to_thread(_extract_info, ytdlp_opts, url)
+    except BaseException:
+        speed_task.cancel()
+        raise
+
+    try:
+        mbps = await speed_task
+        print(f"Speed: {human_readable_speed(mbps)}")
+        connections = choose_connections(mbps)
+        print(f"Using {connections} connections")
+    except Exception:
+        mbps = 0
+        connections = 1
+        print("Speed test failed, using default connection")
+
     if info is None:
         raise RuntimeError("Download failed - no video information received from YouTube")
 
-    # Safely check requested_downloads with None check
-    if info and "requested_downloads" in info and info["requested_downloads"]:
-        for req in info["requested_downloads"]:
-            if req and "filepath" in req:
-                fp = req.get("filepath")
-                if fp and Path(fp).exists():
-                    downloaded_file = Path(fp)
-                    break
+    # When only an MP3 of a single-file format is wanted, encode while downloading
+    # instead of writing the source first. Long sources use the parallel encode instead.
+    stream_to_ffmpeg = (
+        convert_to_mp3 and not keep_original and _HAS_FFMPEG
+        and info.get("format_id") and not info.get("requested_formats")
+        and not (prefer_copy and _copy_extension(info.get("acodec")))
+        and _parallel_jobs(info.get("duration")) == 1
+    )
 
-    # Check filepath in info
-    if not downloaded_file and info and "filepath" in info:
-        fp = info.get("filepath")
-        if fp and Path(fp).exists():
-            downloaded_file = Path(fp)
+    # A stream-copy source already in its target container is the final file,
+    # so it is downloaded straight into output_path
+    copy_as_is = prefer_copy and _copy_extension(info.get("acodec")) == info.get("ext")
 
-    # Search for recently created files as fallback
-    if not downloaded_file:
-        try:
-            files = list(output_path.glob("*"))
-            if files:
+    # Without keep_original the download is only an intermediate for ffmpeg,
+    # so keep it off persistent storage and write just the result to output_path
+    scratch_dir = None
+    download_path = output_path
+    if convert_to_mp3 and not keep_original and not stream_to_ffmpeg and not copy_as_is:
+        headroom = SCRATCH_HEADROOM_PARALLEL if _parallel_jobs(info.get("duration")) > 1 else SCRATCH_HEADROOM
+        scratch_dir = _make_scratch_dir(info.get("filesize") or info.get("filesize_approx"), headroom)
+        download_path = scratch_dir
+        ytdlp_opts["outtmpl"] = safe_outtmpl(download_path)
+        planned_file = download_path / planned_file.name
+
+    try:
+        if stream_to_ffmpeg:
+            abr = info.get("abr") or 0
+            quality = MP3_VBR_QUALITY_LOW if 0 < abr <= LOW_BITRATE_KBPS else MP3_VBR_QUALITY
+            mp3_path = output_path / (planned_file.stem + ".mp3")
+            print("Downloading and converting to MP3...")
+            try:
+                await _download_mp3_piped(info, mp3_path, quality, connections, progress_hook)
+            except subprocess.CalledProcessError as e:
+                print(f"FFmpeg error: {e.stderr}")
+                raise RuntimeError(f"MP3 conversion failed: {e.stderr}")
+            print("MP3 saved:", mp3_path)
+            return {
+                "title": info.get('title', 'Unknown Title'),
+                "status": "success",
+                "files": [{
+                    "name": mp3_path.name,
+                    "type": "mp3",
+                    "size": human_readable_size(mp3_path.stat().st_size),
+                    "format": "MP3"
+                }]
+            }
+
+        use_aria2 = _HAS_ARIA2 and connections > 1
+
+        # yt-dlp only resolves the signed URL of a single-file audio format; aria2c
+        # fetches it (through the shared daemon when available). Segmented formats
+        # are left to yt-dlp's downloader.
+        downloaded = False
+        fmt = _pick_direct_audio_format(info) if use_aria2 else None
+        if fmt:
+            target = planned_file.with_suffix(f".{fmt['ext']}")
+            try:
+                if await asyncio.to_thread(_ensure_aria2_daemon):
+                    await asyncio.to_thread(
+                        _aria2_download, fmt["url"], target, connections, fmt.get("http_headers"), progress_hook
+                    )
+                else:
+                    await _aria2c_cli_download(fmt["url"], target, connections, fmt.get("http_headers"))
+                if fmt is not info:
+                    info = {**info, **fmt}
+                info["filepath"] = str(target)
+                downloaded = True
+            except (OSError, RuntimeError, ValueError) as e:
+                print(f"aria2c download failed: {e}. Falling back to yt-dlp")
+
+        # Fragmented (DASH/HLS) formats get the same parallelism as aria2c
+        ytdlp_opts["concurrent_fragment_downloads"] = connections
+
+        if progress_hook:
+            ytdlp_opts["progress_hooks"] = [progress_hook]
+
+        # Reuse the extracted info so the download does not fetch the page again
+        if not downloaded:
+            info = await asyncio.to_thread(_ytdlp_download, ytdlp_opts, info)
+
+        # ---- FIXED FILE DETECTION ----
+        downloaded_file = None
+
+        # Check if info is None (download might have failed silently)
+        if info is None:
+            raise RuntimeError("Download failed - no video information received from YouTube")
+
+        # Safely check requested_downloads with None check
+        if info and "requested_downloads" in info and info["requested_downloads"]:
+            for req in info["requested_downloads"]:
+                if req and "filepath" in req:
+                    fp = req.get("filepath")
+                    if fp and Path(fp).exists():
+                        downloaded_file = Path(fp)
+                        break
+
+        # Check filepath in info
+        if not downloaded_file and info and "filepath" in info:
+            fp = info.get("filepath")
+            if fp and Path(fp).exists():
+                downloaded_file = Path(fp)
+
+        # Search for recently created files as fallback
+        if not downloaded_file:
+            try:
                 # Filter out non-audio files and get the most recent
-                audio_files = [f for f in files if f.suffix.lower() in ['.webm', '.m4a', '.mp3', '.ogg', '.wav']]
-                if audio_files:
-                    downloaded_file = max(audio_files, key=lambda x: x.stat().st_mtime)
+                with os.scandir(download_path) as entries:
+                    newest = max(
+                        (e for e in entries if e.is_file() and os.path.splitext(e.name)[1].lower() in AUDIO_EXTENSIONS),
+                        key=lambda e: e.stat().st_mtime,
+                        default=None,
+                    )
+                if newest:
+                    downloaded_file = Path(newest.path)
                     print(f"Found file via fallback: {downloaded_file}")
-        except Exception as e:
-            print(f"Error searching for files: {e}")
+            except Exception as e:
+                print(f"Error searching for files: {e}")
 
-    if not downloaded_file:
-        raise RuntimeError("Could not find downloaded audio file. The download may have completed but file was not found.")
+        if not downloaded_file:
+            raise RuntimeError("Could not find downloaded audio file. The download may have completed but file was not found.")
 
-    print("Downloaded:", downloaded_file)
+        print("Downloaded:", downloaded_file)
     
-    # SIMPLIFIED OUTPUT FORMAT
-    video_title = info.get('title', 'Unknown Title') if info else 'Unknown Title'
-    results = {
-        "title": video_title,
-        "status": "success",
-        "files": []
-    }
+        # SIMPLIFIED OUTPUT FORMAT
+        video_title = info.get('title', 'Unknown Title') if info else 'Unknown Title'
+        results = {
+            "title": video_title,
+            "status": "success",
+            "files": []
+        }
+
+        # Add original file info
+        if downloaded_file.exists():
+            results["files"].append({
+                "name": downloaded_file.name,
+                "type": "original",
+                "size": human_readable_size(downloaded_file.stat().st_size),
+                "format": downloaded_file.suffix.replace('.', '').upper()
+            })
+
+        # ---- MP3 conversion ----
+        if convert_to_mp3:
+            if not _HAS_FFMPEG:
+                raise RuntimeError("ffmpeg not found - MP3 conversion unavailable")
+
+            # When the client does not strictly need MP3, keep the source codec
+            copy_ext = _copy_extension(info.get("acodec")) if prefer_copy else None
+            if copy_ext and downloaded_file.suffix.lower() == f".{copy_ext}":
+                print(f"Source is already {copy_ext.upper()}, skipping conversion")
+                if scratch_dir:
+                    # Only reached when a different format than planned was fetched
+                    await asyncio.to_thread(shutil.move, str(downloaded_file), str(output_path / downloaded_file.name))
+                return results
 
-    # Add original file info
-    if downloaded_file.exists():
-        results["files"].append({
-            "name": downloaded_file.name,
-            "type": "original",
-            "size": human_readable_size(downloaded_file.stat().st_size),
-            "format": downloaded_file.suffix.replace('.', '').upper()
-        })
-
-    # ---- MP3 conversion ----
-    if convert_to_mp3:
-        if not check_tool_exists("ffmpeg"):
-            raise RuntimeError("ffmpeg not found - MP3 conversion unavailable")
-
-        mp3_path = output_path / (downloaded_file.stem + ".mp3")
+            if copy_ext:
+                out_path = output_path / (downloaded_file.stem + f".{copy_ext}")
+                file_type = "remux"
+                file_format = copy_ext.upper()
+            else:
+                out_path = output_path / (downloaded_file.stem + ".mp3")
+                file_type = "mp3"
+                file_format = "MP3"
         
-        # Remove existing MP3 file if it exists
-        if mp3_path.exists():
-            mp3_path.unlink()
-            print("Removed existing MP3 file to prevent duplicates")
+            # Remove existing output file if it exists
+            if out_path.exists():
+                out_path.unlink()
+                print(f"Removed existing {file_format} file to prevent duplicates")
 
-        cmd = [
-            "ffmpeg", "-y",
-            "-i", str(downloaded_file),
-            "-vn",
-            "-codec:a", "libmp3lame",
-            "-b:a", "320k",
-            "-ac", "2",
-            "-ar", "44100",
-            str(mp3_path)
-        ]
+            if copy_ext:
+                cmd = [
+                    "ffmpeg", "-y",
+                    "-i", str(downloaded_file),
+                    "-map", "0:a:0",
+                    "-c:a", "copy",
+                    str(out_path)
+                ]
+            else:
+                abr = info.get("abr") or 0
+                quality = MP3_VBR_QUALITY_LOW if 0 < abr <= LOW_BITRATE_KBPS else MP3_VBR_QUALITY
+                cmd = [
+                    "ffmpeg", "-y",
+                    "-threads", "0",
+                    "-i", str(downloaded_file),
+                    "-map", "0:a:0",
+                    *_mp3_encode_args(quality),
+                    str(out_path)
+                ]
 
-        print("Converting to MP3...")
-        try:
-            result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-            print("MP3 conversion completed successfully")
-        except subprocess.CalledProcessError as e:
-            print(f"FFmpeg error: {e.stderr}")
-            raise RuntimeError(f"MP3 conversion failed: {e.stderr}")
+            # Long sources on multicore hosts are encoded in parallel chunks
+            jobs = 1
+            duration = info.get("duration")
+            if not copy_ext:
+                duration = duration or await _probe_duration(downloaded_file)
+                jobs = _parallel_jobs(duration)
+
+            print(f"Converting to {file_format}...")
+            try:
+                if jobs > 1:
+                    print(f"Encoding in {jobs} parallel chunks")
+                    await _encode_mp3_parallel(downloaded_file, out_path, duration, jobs, quality)
+                else:
+                    await _run_ffmpeg(cmd, progress_hook, duration)
+                print(f"{file_format} conversion completed successfully")
+            except subprocess.CalledProcessError as e:
+                print(f"FFmpeg error: {e.stderr}")
+                raise RuntimeError(f"{file_format} conversion failed: {e.stderr}")
         
-        print("MP3 saved:", mp3_path)
+            print(f"{file_format} saved:", out_path)
         
-        # Add MP3 file info
-        if mp3_path.exists():
-            results["files"].append({
-                "name": mp3_path.name,
-                "type": "mp3",
-                "size": human_readable_size(mp3_path.stat().st_size),
-                "format": "MP3"
-            })
+            # Add converted file info
+            if out_path.exists():
+                results["files"].append({
+                    "name": out_path.name,
+                    "type": file_type,
+                    "size": human_readable_size(out_path.stat().st_size),
+                    "format": file_format
+                })
 
-        if not keep_original and downloaded_file.exists():
-            downloaded_file.unlink()
-            results["files"] = [f for f in results["files"] if f["type"] != "original"]
-            print("Original file removed as requested")
+            if not keep_original and downloaded_file.exists():
+                downloaded_file.unlink()
+                results["files"] = [f for f in results["files"] if f["type"] != "original"]
+                print("Original file removed as requested")
 
-    return results
\ No newline at end of file
+        return results
+    finally:
+        if scratch_dir:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
\ No newline at end of file
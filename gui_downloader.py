@@ -1,3 +1,4 @@
+import asyncio
 import threading
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
@@ -343,13 +344,13 @@ class YouTubeAudioDownloaderGUI:
                     except:
                         pass
 
-            result = download_audio_from_youtube(
+            result = asyncio.run(download_audio_from_youtube(
                 url,
                 output_dir=download_dir,
                 convert_to_mp3=self.mp3_var.get(),
                 keep_original=self.keep_original_var.get(),
                 progress_hook=progress_callback
-            )
+            ))
             
             # Update UI in main thread
             self.root.after(0, self.on_download_complete, result, url, download_dir)
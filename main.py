@@ -24,6 +24,7 @@ class DownloadRequest(BaseModel):
     url: str
     convert_mp3: bool
     keep_original: bool
+    prefer_copy: bool = False
 
 # Temporary directory for web downloads
 TEMP_DOWNLOAD_DIR = Path("temp_downloads")
@@ -79,11 +80,12 @@ async def download_file(request: DownloadRequest, background_tasks: BackgroundTa
         print(f"Downloading to temporary directory: {temp_dir}")
         
         # Download the file
-        result = download_audio_from_youtube(
+        result = await download_audio_from_youtube(
             url=request.url,
             output_dir=str(temp_dir),
             convert_to_mp3=request.convert_mp3,
-            keep_original=request.keep_original
+            keep_original=request.keep_original,
+            prefer_copy=request.prefer_copy
         )
         
         print(f"Download result: {result}")
@@ -92,12 +94,12 @@ async def download_file(request: DownloadRequest, background_tasks: BackgroundTa
         file_to_serve = None
         file_type = None
         
-        # Priority: MP3 if requested and available
+        # Priority: converted file (MP3 or stream copy) if requested and available
         if request.convert_mp3:
             for file_info in result.get("files", []):
-                if file_info["type"] == "mp3":
+                if file_info["type"] in ("mp3", "remux"):
                     file_to_serve = Path(temp_dir) / file_info["name"]
-                    file_type = "mp3"
+                    file_type = file_info["type"]
                     break
         
         # If no MP3 found or not requested, look for original
@@ -118,7 +120,7 @@ async def download_file(request: DownloadRequest, background_tasks: BackgroundTa
         filename = file_to_serve.name
         if file_to_serve.suffix.lower() == '.mp3':
             media_type = 'audio/mpeg'
-        elif file_to_serve.suffix.lower() in ['.webm', '.m4a', '.ogg']:
+        elif file_to_serve.suffix.lower() in ['.webm', '.m4a', '.ogg', '.opus']:
             media_type = 'audio/*'
         else:
             media_type = 'application/octet-stream'
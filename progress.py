@@ -4,8 +4,8 @@ from downloader_core import download_audio_from_youtube
 def sse_format(data):
     return f"data: {json.dumps(data)}\n\n"
 
-def stream_download(url, convert, keep):
-    """Generator function that yields progress updates"""
+async def stream_download(url, convert, keep):
+    """Async generator that yields progress updates"""
     
     # Yield initial status
     yield sse_format({
@@ -38,7 +38,7 @@ def stream_download(url, convert, keep):
 
     try:
         # Run download task with progress hook
-        results = download_audio_from_youtube(
+        results = await download_audio_from_youtube(
             url,
             convert_to_mp3=convert,
             keep_original=keep,